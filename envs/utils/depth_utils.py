@@ -17,7 +17,9 @@
 """
 from argparse import Namespace
 
+import functools
 import itertools
+import math
 import mindspore as ms
 import mindspore.numpy as np
 from mindspore import Tensor, ops
@@ -30,11 +32,70 @@ stack = ops.Stack(axis=-1)
 floor = ops.Floor()
 
 
+@functools.lru_cache(maxsize=None)
+def _projection_rays(height, width, scale, xc, zc, f):
+    """Returns the per-pixel rays (x - xc) / f and (z - zc) / f for an
+    image of size height x width, subsampled by scale. Cached since the
+    camera resolution is fixed across a rollout."""
+    grid_x, grid_z = meshgrid((np.arange(width),
+                               np.arange(height - 1, -1, -1)))
+    rx = (grid_x[::scale, ::scale].astype(ms.float32) - xc) / f
+    rz = (grid_z[::scale, ::scale].astype(ms.float32) - zc) / f
+    return rx, rz
+
+
+@functools.lru_cache(maxsize=None)
+def _projection_ray_dirs(height, width, scale, xc, zc, f):
+    """Returns the per-pixel rays stacked as ((x - xc) / f, 1, (z - zc) / f),
+    i.e. the point cloud of a unit depth image, of size H x W x 3."""
+    rx, rz = _projection_rays(height, width, scale, xc, zc, f)
+    return stack([rx, ops.ones_like(rx), rz])
+
+
+@functools.lru_cache(maxsize=None)
+def _depth_rays(height, width, cx, cy, fx, fy, dtype):
+    """Returns the per-pixel rays ((u - cx) / fx, (v - cy) / fy, 1) of a
+    pinhole camera, of size H x W x 3, stored in dtype."""
+    u, v = meshgrid((ops.arange(0, width), ops.arange(0, height)))
+    u = u.astype(ms.float32)
+    v = v.astype(ms.float32)
+    rays = stack([(u - cx) / fx, (v - cy) / fy, ops.ones_like(u)])
+    return rays.astype(dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _camera_view_transform(camera_elevation_degree, sensor_height):
+    """Returns (R.T, t) as float32 Tensors for the camera elevation and the
+    sensor height, so that points are transformed with XYZ @ R.T + t. Cached
+    since both are constant across a rollout; arguments must be floats."""
+    R = ru.get_r_matrix(
+        [1., 0., 0.], angle=math.radians(camera_elevation_degree))
+    return Tensor(R.T, ms.float32), Tensor([0., 0., sensor_height], ms.float32)
+
+
+def _pose_transform(current_pose):
+    """Returns (R.T, t) as float32 Tensors for the yaw current_pose[2] - pi / 2
+    about z and the shift by (x, y, 0). R is built on the device from the sin
+    and cos of the yaw, since the pose changes every frame."""
+    if not isinstance(current_pose, Tensor):
+        current_pose = Tensor(current_pose, ms.float32)
+    yaw = current_pose[2] - math.pi / 2.
+    c = ops.cos(yaw)
+    s = ops.sin(yaw)
+    zero = ops.zeros_like(c)
+    one = ops.ones_like(c)
+    R_T = ops.stack([ops.stack([c, s, zero]),
+                     ops.stack([-s, c, zero]),
+                     ops.stack([zero, zero, one])])
+    t = ops.stack([current_pose[0], current_pose[1], zero])
+    return R_T, t
+
+
 def get_camera_matrix(width, height, fov):
     """Returns a camera matrix from image size and fov."""
     xc = (width - 1.) / 2.
     zc = (height - 1.) / 2.
-    f = (width / 2.) / np.tan(np.deg2rad(ms.Tensor(fov / 2.)))
+    f = (width / 2.) / math.tan(math.radians(fov / 2.))
     camera_matrix = {'xc': xc, 'zc': zc, 'f': f}
     camera_matrix = Namespace(**camera_matrix)
     return camera_matrix
@@ -43,7 +104,7 @@ def get_camera_matrix(width, height, fov):
 def get_camera_intrinsic_parameters(width, height, hfov):
     """Returns a camera matrix from image size and fov."""
     aspect_ratio = 1.0 * width / height
-    temp = np.tan(np.deg2rad(ms.Tensor(hfov / 2.)))
+    temp = math.tan(math.radians(hfov / 2.))
 
     cx = width / 2.
     cy = height / 2.
@@ -70,17 +131,13 @@ def get_point_cloud_from_z(Y, camera_matrix, scale=1):
         Z is positive up in the image
         XYZ is ...xHxWx3
     """
-    x, z = meshgrid((np.arange(Y.shape[-1]), np.arange(Y.shape[-2] - 1, -1, -1)))
-    for _ in range(Y.ndim - 2):
-        x = np.expand_dims(x, axis=0)
-        z = np.expand_dims(z, axis=0)
-    X = (x[::scale, ::scale] - camera_matrix.xc) * \
-        Y[::scale, ::scale] / camera_matrix.f
-    Z = (z[::scale, ::scale] - camera_matrix.zc) * \
-        Y[::scale, ::scale] / camera_matrix.f
-    XYZ = np.concatenate((X[..., np.newaxis],
-                          Y[::scale, ::scale][..., np.newaxis],
-                          Z[..., np.newaxis]), axis=X.ndim)
+    # The H x W rays broadcast against any leading dims of Y.
+    rx, rz = _projection_rays(Y.shape[-2], Y.shape[-1], scale,
+                              float(camera_matrix.xc),
+                              float(camera_matrix.zc),
+                              float(camera_matrix.f))
+    Y = Y[..., ::scale, ::scale]
+    XYZ = stack([rx * Y, Y, rz * Y])
     return XYZ
 
 
@@ -96,7 +153,7 @@ def transform_camera_view(XYZ, sensor_height, camera_elevation_degree):
         XYZ : ...x3
     """
     R = ru.get_r_matrix(
-        [1., 0., 0.], angle=np.deg2rad(ms.Tensor(camera_elevation_degree)))
+        [1., 0., 0.], angle=math.radians(camera_elevation_degree))
     XYZ = np.matmul(XYZ.reshape(-1, 3), R.T).reshape(XYZ.shape)
     XYZ[..., 2] = XYZ[..., 2] + sensor_height
     return XYZ
@@ -119,6 +176,16 @@ def transform_pose(XYZ, current_pose):
     return XYZ
 
 
+def _digitize(Z, bins):
+    """Branchless np.digitize of Z into the increasing bins, returning int32
+    indices in [0, len(bins)]. z_bins only holds a handful of height
+    thresholds, so this is unrolled into one compare per edge."""
+    Z_bin = ops.zeros_like(Z, dtype=ms.int32)
+    for b in bins:
+        Z_bin = Z_bin + (Z >= b).astype(ms.int32)
+    return Z_bin
+
+
 def bin_points(XYZ_cms, map_size, z_bins, xy_resolution):
     """Bins points into xy-z bins
     XYZ_cms is ... x H x W x3
@@ -126,26 +193,32 @@ def bin_points(XYZ_cms, map_size, z_bins, xy_resolution):
     """
     sh = XYZ_cms.shape
     XYZ_cms = XYZ_cms.reshape([-1, sh[-3], sh[-2], sh[-1]])
+    n_batch = XYZ_cms.shape[0]
     n_z_bins = len(z_bins) + 1
-    counts = []
-    for XYZ_cm in XYZ_cms:
-        isnotnan = np.logical_not(np.isnan(XYZ_cm[:, :, 0]))
-        X_bin = np.round(XYZ_cm[:, :, 0] / xy_resolution).astype(np.int32)
-        Y_bin = np.round(XYZ_cm[:, :, 1] / xy_resolution).astype(np.int32)
-        Z_bin = np.digitize(XYZ_cm[:, :, 2], bins=z_bins).astype(np.int32)
-
-        isvalid = np.array([X_bin >= 0, X_bin < map_size, Y_bin >= 0,
-                            Y_bin < map_size,
-                            Z_bin >= 0, Z_bin < n_z_bins, isnotnan])
-        isvalid = np.all(isvalid, axis=0)
-
-        ind = (Y_bin * map_size + X_bin) * n_z_bins + Z_bin
-        ind[np.logical_not(isvalid)] = 0
-        count = np.bincount(ind.ravel(), isvalid.ravel().astype(np.int32),
-                            minlength=map_size * map_size * n_z_bins)
-        counts = np.reshape(count, [map_size, map_size, n_z_bins])
-
-    counts = counts.reshape(list(sh[:-3]) + [map_size, map_size, n_z_bins])
+    n_bins = map_size * map_size * n_z_bins
+
+    isnotnan = np.logical_not(np.isnan(XYZ_cms[..., 0]))
+    X_bin = ops.round(XYZ_cms[..., 0] / xy_resolution).astype(ms.int32)
+    Y_bin = ops.round(XYZ_cms[..., 1] / xy_resolution).astype(ms.int32)
+    Z_bin = _digitize(XYZ_cms[..., 2], list(z_bins))
+
+    # Z_bin is always in [0, n_z_bins) by construction.
+    isvalid = (X_bin >= 0) & (X_bin < map_size) & (Y_bin >= 0) & \
+        (Y_bin < map_size) & isnotnan
+
+    # Flat index over the whole batch; invalid points go to a sentinel bin
+    # past the end which is dropped after the scatter, so the updates never
+    # come out empty even when no point is valid.
+    b = np.arange(n_batch, dtype=ms.int32).reshape(-1, 1, 1)
+    ind = ((b * map_size + Y_bin) * map_size + X_bin) * n_z_bins + Z_bin
+    ind = ops.select(isvalid, ind, ops.full_like(ind, n_batch * n_bins))
+
+    counts = ops.zeros((n_batch * n_bins + 1,), ms.int32)
+    counts = ops.tensor_scatter_add(counts, ind.reshape(-1, 1),
+                                    ops.ones_like(ind).reshape(-1))
+
+    counts = counts[:-1].reshape(list(sh[:-3]) +
+                                 [map_size, map_size, n_z_bins])
 
     return counts
 
@@ -161,19 +234,16 @@ def get_point_cloud_from_z_t(Y_t, camera_matrix, scale=1):
         Z is positive up in the image
         XYZ is ...xHxWx3
     """
-    grid_x, grid_z = meshgrid((np.arange(Y_t.shape[-1]),
-                                    np.arange(Y_t.shape[-2] - 1, -1, -1)))
-    broadcast_to = ops.BroadcastTo(Y_t.shape)
-    grid_x = broadcast_to(grid_x.unsqueeze(0))
-    grid_z = broadcast_to(grid_z.unsqueeze(0))
+    rx, rz = _projection_rays(Y_t.shape[-2], Y_t.shape[-1], scale,
+                              float(camera_matrix.xc),
+                              float(camera_matrix.zc),
+                              float(camera_matrix.f))
+    Y_t = Y_t[..., ::scale, ::scale]
 
-    X_t = (grid_x[:, ::scale, ::scale] - camera_matrix.xc) * \
-        Y_t[:, ::scale, ::scale] / camera_matrix.f
-    Z_t = (grid_z[:, ::scale, ::scale] - camera_matrix.zc) * \
-        Y_t[:, ::scale, ::scale] / camera_matrix.f
+    X_t = rx * Y_t
+    Z_t = rz * Y_t
 
-    XYZ = stack(
-        [X_t, Y_t[:, ::scale, ::scale], Z_t])
+    XYZ = stack([X_t, Y_t, Z_t])
 
     return XYZ
 
@@ -190,12 +260,10 @@ def transform_camera_view_t(
     Output:
         XYZ : ...x3
     """
-    R = ru.get_r_matrix(
-        [1., 0., 0.], angle=np.deg2rad(ms.Tensor(camera_elevation_degree)))
-    XYZ = ops.matmul(XYZ.reshape(-1, 3).float(),
-                       Tensor.from_numpy(R).float().transpose(1, 0)
-                       ).reshape(XYZ.shape)
-    XYZ[..., 2] = XYZ[..., 2] + sensor_height
+    R_T, t = _camera_view_transform(float(camera_elevation_degree),
+                                    float(sensor_height))
+    XYZ = ops.matmul(XYZ.float(), R_T)
+    XYZ = ops.add(XYZ, t)
     return XYZ
 
 
@@ -209,48 +277,93 @@ def transform_pose_t(XYZ, current_pose):
     Output:
         XYZ : ...x3
     """
-    R = ru.get_r_matrix([0., 0., 1.], angle=current_pose[2] - np.pi / 2.)
-    XYZ = ops.matmul(XYZ.reshape(-1, 3),
-                       Tensor.from_numpy(R).float().transpose(1, 0)
-                       ).reshape(XYZ.shape)
-    XYZ[..., 0] += current_pose[0]
-    XYZ[..., 1] += current_pose[1]
+    R_T, t = _pose_transform(current_pose)
+    XYZ = ops.matmul(XYZ, R_T)
+    XYZ = ops.add(XYZ, t)
     return XYZ
 
 
-def depth_image_to_point_cloud(depth, scale, cx, cy, fx, fy, matrix):
-    device = depth.device
-    bs, h, w = depth.shape
-
-    u = ops.arange(0, w)
-    v = ops.arange(0, h)
+@ms.jit
+def project_and_transform(Y, rays, R_cam_T, t_cam, R_pose_T, t_pose):
+    """
+    Scales the unit-depth rays by the depth image Y and applies the camera
+    view transform followed by the pose transform, composed into a single
+    XYZ @ R_T + t and compiled as one graph.
+    Input:
+        Y                : ...xHxW
+        rays             : HxWx3
+        R_cam_T, R_pose_T: 3x3
+        t_cam, t_pose    : 3
+    Output:
+        XYZ : ...xHxWx3
+    """
+    R_T = ops.matmul(R_cam_T, R_pose_T)
+    t = ops.matmul(t_cam, R_pose_T) + t_pose
+    XYZ = ops.expand_dims(Y, -1) * rays
+    return ops.matmul(XYZ, R_T) + t
 
-    v, u = meshgrid((v, u))
-    u = u.float().cuda(device)
-    v = v.float().cuda(device)
-    u = u.unsqueeze(0).repeat(bs, 1, 1)
-    v = v.unsqueeze(0).repeat(bs, 1, 1)
 
-    Z = depth / scale
-    X = (u - cx) * Z / fx
-    Y = (v - cy) * Z / fy
+def transform_point_cloud_fused(Y_t, camera_matrix, sensor_height,
+                                camera_elevation_degree, current_pose,
+                                scale=1):
+    """
+    Projects the depth image Y into a 3D point cloud in the geocentric frame.
+    Equivalent to get_point_cloud_from_z_t followed by transform_camera_view_t
+    and transform_pose_t, but applies both rotations as a single matmul.
+    Input:
+        Y_t                     : ...xHxW
+        camera_matrix
+        sensor_height           : height of the sensor
+        camera_elevation_degree : camera elevation to rectify.
+        current_pose            : camera position (x, y, theta (radians))
+    Output:
+        XYZ : ...xHxWx3
+    """
+    rays = _projection_ray_dirs(Y_t.shape[-2], Y_t.shape[-1], scale,
+                                float(camera_matrix.xc),
+                                float(camera_matrix.zc),
+                                float(camera_matrix.f))
+    R_cam_T, t_cam = _camera_view_transform(float(camera_elevation_degree),
+                                            float(sensor_height))
+    R_pose_T, t_pose = _pose_transform(current_pose)
+
+    XYZ = project_and_transform(Y_t[..., ::scale, ::scale], rays,
+                                R_cam_T, t_cam, R_pose_T, t_pose)
+    return XYZ
 
-    X = X.flatten()
-    Y = Y.flatten()
-    Z = Z.flatten()
 
-    valid = Z > 0
+def depth_image_to_point_cloud(depth, scale, cx, cy, fx, fy, matrix,
+                               dtype=ms.float16):
+    """
+    Back-projects a batch of depth images and applies the extrinsic matrix.
+    Input:
+        depth  : B x H x W
+        matrix : 4 x 4 or B x 4 x 4 camera to world transform
+        dtype  : dtype of the back-projected camera frame points; the
+                 extrinsic transform runs in the matrix dtype
+    Output:
+        points : B x H x W x 3
+        valid  : B x H x W, False where the depth is not positive or the
+                 point is not finite
+    """
+    _, h, w = depth.shape
+    rays = _depth_rays(h, w, float(cx), float(cy), float(fx), float(fy),
+                       dtype)
 
-    X = X[valid]
-    Y = Y[valid]
-    Z = Z[valid]
+    # Scale before casting so that large raw depths do not overflow dtype.
+    depth = depth / scale
+    points = depth.astype(dtype).unsqueeze(-1) * rays
+    points = points.astype(matrix.dtype)
 
-    position = ops.vstack((X, Y, Z, ops.ones(len(X)).cuda(device))).view(bs, 4, -1)
-    position = ops.bmm(matrix.cuda(device).unsqueeze(0).repeat(bs, 1, 1), position)
+    if matrix.ndim == 2:
+        matrix = matrix.unsqueeze(0)
+    R_T = matrix[:, :3, :3].swapaxes(1, 2).unsqueeze(1)
+    t = matrix[:, :3, 3].reshape(-1, 1, 1, 3)
+    points = ops.matmul(points, R_T) + t
 
-    points = position[:, 0:3, :].view(bs, 3, h, w).permute(0, 2, 3, 1)
+    valid = (depth > 0) & ops.isfinite(points).all(axis=-1)
 
-    return points
+    return points, valid
 
 
 def splat_feat_nd(init_grid, feat, coords):
@@ -262,8 +375,6 @@ def splat_feat_nd(init_grid, feat, coords):
     Returns:
         grid: B X nF X W X H X D X ..
     """
-    wts_dim = []
-    pos_dim = []
     grid_dims = init_grid.shape[2:]
 
     B = init_grid.shape[0]
@@ -273,44 +384,48 @@ def splat_feat_nd(init_grid, feat, coords):
 
     grid_flat = init_grid.view(B, F, -1)
 
-    for d in range(n_dims):
-        pos = coords[:, [d], :] * grid_dims[d] / 2 + grid_dims[d] / 2
-        pos_d = []
-        wts_d = []
-
-        for ix in [0, 1]:
-            pos_ix = floor(pos) + ix
-            safe_ix = (pos_ix > 0) & (pos_ix < grid_dims[d])
-            safe_ix = safe_ix.float()
-
-            wts_ix = 1 - ops.abs(pos - pos_ix)
+    grid_dims_t = Tensor(grid_dims, ms.float32).reshape(1, -1, 1)
+    grid_dims_half = grid_dims_t * 0.5
+    pos = coords * grid_dims_half + grid_dims_half
 
-            wts_ix = wts_ix * safe_ix
-            pos_ix = pos_ix * safe_ix
+    # Positions and weights of the lower (ix = 0) and upper (ix = 1) corners
+    # along every dimension at once, each 2 x B x nDims x nPt.
+    pos_lo = floor(pos)
+    wts_hi = pos - pos_lo
+    pos_ix = ops.stack([pos_lo, pos_lo + 1])
+    wts_ix = ops.stack([1 - wts_hi, wts_hi])
 
-            pos_d.append(pos_ix)
-            wts_d.append(wts_ix)
+    safe_ix = (pos_ix > 0) & (pos_ix < grid_dims_t)
+    safe_ix = safe_ix.float()
 
-        pos_dim.append(pos_d)
-        wts_dim.append(wts_d)
+    wts_ix = wts_ix * safe_ix
+    pos_ix = pos_ix * safe_ix
 
     l_ix = [[0, 1] for d in range(n_dims)]
 
+    index_ix = []
+    updates_ix = []
     for ix_d in itertools.product(*l_ix):
-        wts = ops.ones_like(wts_dim[0][0])
-        index = ops.zeros_like(wts_dim[0][0])
+        wts = ops.ones_like(wts_ix[0, :, :1, :])
+        index = ops.zeros_like(wts)
         for d in range(n_dims):
-            index = index * grid_dims[d] + pos_dim[d][ix_d[d]]
-            wts = wts * wts_dim[d][ix_d[d]]
-
-        index = index.long()
-        # broadcast_to = ops.BroadcastTo((index.shape[0], F, index.shape[2]))
-        # index = broadcast_to(index)
-        # scatter_nd_add = ops.ScatterNdAdd()
-        # grid_flat = scatter_nd_add(grid_flat, index, feat * wts)
-        updates = feat * wts
-        assert index.shape[0] == 1
-        grid_flat[..., index[0, 0, :]] += updates
-        grid_flat = ops.round(grid_flat)
+            index = index * grid_dims[d] + pos_ix[ix_d[d], :, d:d + 1, :]
+            wts = wts * wts_ix[ix_d[d], :, d:d + 1, :]
+
+        index_ix.append(index.astype(ms.int32))
+        updates_ix.append(feat * wts)
+
+    # Scatter all 2^nDims corners into the flattened B x nF x (W*H*D*..) grid
+    # at once, offsetting the cell index by the batch and feature channel.
+    # Points landing in the same cell accumulate, as with scatter_add_.
+    index = ops.concat(index_ix, axis=-1)
+    updates = ops.concat(updates_ix, axis=-1)
+    index = index + (ops.arange(B * F, dtype=ms.int32) *
+                     grid_flat.shape[-1]).reshape(B, F, 1)
+    grid_flat = ops.tensor_scatter_add(grid_flat.reshape(-1),
+                                       index.reshape(-1, 1),
+                                       updates.reshape(-1))
+
+    grid_flat = ops.round(grid_flat)
 
     return grid_flat.view(init_grid.shape)
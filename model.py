@@ -46,8 +46,9 @@ class Semantic_Mapping(nn.Cell):
             self.min_z_consider = min_height
 
         self.agent_height = args.camera_height * 100.
-        self.shift_loc = [self.vision_range *
-                          self.resolution // 2, 0, np.pi / 2.0]
+        self.shift_loc = ms.Tensor([self.vision_range *
+                                    self.resolution // 2, 0, np.pi / 2.0],
+                                   ms.float32)
         # self.camera_matrix = du.get_camera_matrix(
         #     self.screen_w, self.screen_h, self.fov)
         self.camera_matrix = du.get_camera_intrinsic_parameters(
@@ -70,18 +71,13 @@ class Semantic_Mapping(nn.Cell):
         bs, c, h, w = obs.shape
         depth = obs[:, 3, :, :]
 
-        point_cloud_t = du.get_point_cloud_from_z_t(
-            depth, self.camera_matrix, scale=self.du_scale)
-
-        agent_view_t = du.transform_camera_view_t(
-            point_cloud_t, self.agent_height, 0)
-
-        # agent_view_t = du.depth_image_to_point_cloud(
+        # agent_view_t, _ = du.depth_image_to_point_cloud(
         #     depth, self.du_scale, self.camera_matrix.cx, self.camera_matrix.cy,
         #     self.camera_matrix.fx, self.camera_matrix.fy, camera_param['matrix'])
 
-        agent_view_centered_t = du.transform_pose_t(
-                agent_view_t, self.shift_loc)
+        agent_view_centered_t = du.transform_point_cloud_fused(
+            depth, self.camera_matrix, self.agent_height, 0, self.shift_loc,
+            scale=self.du_scale)
 
         max_h = self.max_height
         min_h = self.min_height